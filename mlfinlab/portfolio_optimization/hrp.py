@@ -1,11 +1,10 @@
 # pylint: disable=missing-module-docstring
 import numpy as np
 import pandas as pd
-from scipy.cluster.hierarchy import linkage as scipy_linkage, dendrogram
+from numba import njit, float64, intp, void
+from scipy.cluster.hierarchy import linkage as scipy_linkage, dendrogram, leaves_list
 from scipy.spatial.distance import squareform
-from mlfinlab.portfolio_optimization.returns_estimators import ReturnsEstimators
-from mlfinlab.portfolio_optimization.risk_metrics import RiskMetrics
-from mlfinlab.portfolio_optimization.risk_estimators import RiskEstimators
+from scipy.linalg.blas import dsyrk  # pylint: disable=no-name-in-module
 
 
 class HierarchicalRiskParity:
@@ -28,9 +27,6 @@ class HierarchicalRiskParity:
         self.seriated_correlations = None
         self.ordered_indices = None
         self.clusters = None
-        self.returns_estimator = ReturnsEstimators()
-        self.risk_metrics = RiskMetrics()
-        self.risk_estimator = RiskEstimators()
 
     def allocate(self,
                  asset_names=None,
@@ -39,7 +35,8 @@ class HierarchicalRiskParity:
                  covariance_matrix=None,
                  distance_matrix=None,
                  side_weights=None,
-                 linkage='single'):
+                 linkage='single',
+                 dtype='float64'):
         # pylint: disable=invalid-name, too-many-branches
         """
         Calculate asset allocations using HRP algorithm.
@@ -54,10 +51,13 @@ class HierarchicalRiskParity:
                                                       (default 1 for all)
         :param linkage: (string) Type of linkage used for Hierarchical Clustering. Supported strings - ``single``,
                                  ``average``, ``complete``, ``ward``.
+        :param dtype: (string) Floating point precision of the distances used for Hierarchical Clustering. Supported
+                               strings - ``float64``, ``float32``. The covariance matrix used for the weights is
+                               always kept in ``float64``.
         """
 
         # Perform error checks
-        self._error_checks(asset_prices, asset_returns, covariance_matrix)
+        self._error_checks(asset_prices, asset_returns, covariance_matrix, dtype)
 
         if asset_names is None:
             if asset_prices is not None:
@@ -67,34 +67,50 @@ class HierarchicalRiskParity:
             else:
                 raise ValueError("Please provide a list of asset names")
 
-        # Calculate the returns if the user does not supply a returns dataframe
-        if asset_returns is None and covariance_matrix is None:
-            asset_returns = self.returns_estimator.calculate_returns(asset_prices=asset_prices)
-        asset_returns = pd.DataFrame(asset_returns, columns=asset_names)
-
-        # Calculate covariance of returns or use the user specified covariance matrix
+        # Calculate covariance of returns or use the user specified covariance matrix. Returns are only
+        # needed (and calculated if not supplied) when there is no covariance matrix to start from
         if covariance_matrix is None:
-            covariance_matrix = asset_returns.cov()
+            if asset_returns is None:
+                asset_returns = self._calculate_returns(asset_prices)
+            asset_returns = pd.DataFrame(asset_returns, columns=asset_names)
+            covariance_matrix = self._calculate_covariance(asset_returns)
         covariance_matrix = pd.DataFrame(covariance_matrix, index=asset_names, columns=asset_names)
 
-        # Calculate correlation and distance from covariance matrix
-        correlation_matrix = self.risk_estimator.cov_to_corr(covariance_matrix)
+        # All later steps work on a single C-contiguous float64 copy of the covariance matrix
+        covariance = np.ascontiguousarray(covariance_matrix.values, dtype=np.float64)
+
+        # Derive correlation from the covariance matrix by scaling with the inverse standard deviations
+        inv_std = 1 / np.sqrt(np.diag(covariance))
+        correlation = covariance * np.outer(inv_std, inv_std)
+        np.clip(correlation, -1, 1, out=correlation)
+        correlation_matrix = pd.DataFrame(correlation, index=asset_names, columns=asset_names)
+
+        # Calculate distance from correlation matrix - sqrt((1 - corr) / 2). Only the condensed upper triangle
+        # of the correlations is needed for clustering, so the distances are computed in place on that vector
         if distance_matrix is None:
-            distance_matrix = np.sqrt((1 - correlation_matrix).round(5) / 2)
-        distance_matrix = pd.DataFrame(distance_matrix, index=asset_names, columns=asset_names)
+            condensed_distance = squareform(correlation, checks=False).astype(dtype, copy=False)
+            np.subtract(1, condensed_distance, out=condensed_distance)
+            np.round(condensed_distance, 5, out=condensed_distance)
+            np.multiply(condensed_distance, 0.5, out=condensed_distance)
+            np.sqrt(condensed_distance, out=condensed_distance)
+            distance_matrix = pd.DataFrame(squareform(condensed_distance, checks=False), index=asset_names,
+                                           columns=asset_names)
+        else:
+            distance_matrix = pd.DataFrame(distance_matrix, index=asset_names, columns=asset_names)
+            condensed_distance = squareform(distance_matrix.values, checks=False).astype(dtype, copy=False)
 
         # Step-1: Tree Clustering
-        self.clusters = self._tree_clustering(distance=distance_matrix, method=linkage)
+        self.clusters = self._tree_clustering(distance=condensed_distance, method=linkage)
 
         # Step-2: Quasi Diagnalization
         num_assets = len(asset_names)
-        self.ordered_indices = self._quasi_diagnalization(num_assets, 2 * num_assets - 2)
+        self.ordered_indices = self._quasi_diagnalization()
         self.seriated_distances, self.seriated_correlations = self._get_seriated_matrix(assets=asset_names,
                                                                                         distance=distance_matrix,
                                                                                         correlation=correlation_matrix)
 
         # Step-3: Recursive Bisection
-        self._recursive_bisection(covariance=covariance_matrix, assets=asset_names)
+        self._recursive_bisection(covariance=covariance, assets=asset_names)
 
         # Build Long/Short portfolio
         if side_weights is None:
@@ -113,35 +129,73 @@ class HierarchicalRiskParity:
         dendrogram_plot = dendrogram(self.clusters, labels=assets)
         return dendrogram_plot
 
+    @staticmethod
+    def _calculate_returns(asset_prices):
+        """
+        Calculate simple returns from asset prices. Equivalent to ReturnsEstimators.calculate_returns, but the
+        division and subtraction are fused in a single pass over the prices.
+
+        :param asset_prices: (pd.Dataframe) A dataframe of historical asset prices (daily close)
+        :return: (pd.Dataframe) Returns per asset
+        """
+
+        prices = asset_prices.values
+        if np.isnan(prices).any():
+            # Missing prices are padded forward, like pd.DataFrame.pct_change does
+            prices = asset_prices.ffill().values
+
+        # Pandas hands out Fortran-ordered values, the kernel streams over C-ordered rows
+        returns = _simple_returns(np.ascontiguousarray(prices, dtype=np.float64))
+        asset_returns = pd.DataFrame(returns, index=asset_prices.index[1:], columns=asset_prices.columns)
+        return asset_returns.dropna(how='all')
+
+    @staticmethod
+    def _calculate_covariance(asset_returns):
+        """
+        Calculate the sample covariance matrix of asset returns.
+
+        The returns are demeaned and multiplied with a symmetric rank-k update (BLAS syrk), which only computes
+        the upper triangle - half the work of a general matrix product. Returns with missing values fall back to
+        pandas, which handles them pairwise.
+
+        :param asset_returns: (pd.Dataframe) Returns per asset
+        :return: (np.array) Covariance matrix of asset returns
+        """
+
+        returns = np.ascontiguousarray(asset_returns.values, dtype=np.float64)
+        if np.isnan(returns).any():
+            return asset_returns.cov().values
+
+        num_observations = returns.shape[0]
+        demeaned_returns = returns - returns.mean(axis=0)
+
+        # The transpose of the C-ordered returns is Fortran-ordered, so BLAS reads it without a copy
+        covariance = dsyrk(1 / (num_observations - 1), demeaned_returns.T)
+        lower = np.tril_indices_from(covariance, k=-1)
+        covariance[lower] = covariance.T[lower]
+        return covariance
+
     @staticmethod
     def _tree_clustering(distance, method='single'):
         """
         Perform the traditional heirarchical tree clustering.
 
-        :param correlation: (np.array) Correlation matrix of the assets
+        :param distance: (np.array) Condensed (upper triangular) distance vector of the assets
         :param method: (str) The type of clustering to be done
-        :return: (np.array) Distance matrix and clusters
+        :return: (np.array) Linkage matrix of the clusters
         """
 
-        clusters = scipy_linkage(squareform(distance.values), method=method)
+        clusters = scipy_linkage(distance, method=method)
         return clusters
 
-    def _quasi_diagnalization(self, num_assets, curr_index):
+    def _quasi_diagnalization(self):
         """
         Rearrange the assets to reorder them according to hierarchical tree clustering order.
 
-        :param num_assets: (int) The total number of assets
-        :param curr_index: (int) Current index
-        :return: (list) The assets rearranged according to hierarchical clustering
+        :return: (np.array) The asset indices rearranged according to hierarchical clustering
         """
 
-        if curr_index < num_assets:
-            return [curr_index]
-
-        left = int(self.clusters[curr_index - num_assets, 0])
-        right = int(self.clusters[curr_index - num_assets, 1])
-
-        return (self._quasi_diagnalization(num_assets, left) + self._quasi_diagnalization(num_assets, right))
+        return leaves_list(self.clusters).astype(np.intp, copy=False)
 
     def _get_seriated_matrix(self, assets, distance, correlation):
         """
@@ -167,80 +221,34 @@ class HierarchicalRiskParity:
                                                       (default 1 for all)
         """
 
-        short_ptf = side_weights[side_weights == -1].index
-        buy_ptf = side_weights[side_weights == 1].index
-        if len(short_ptf) > 0:
-            # Short half size
-            self.weights.loc[short_ptf] /= self.weights.loc[short_ptf].sum().values[0]
-            self.weights.loc[short_ptf] *= -0.5
-
-            # Buy other half
-            self.weights.loc[buy_ptf] /= self.weights.loc[buy_ptf].sum().values[0]
-            self.weights.loc[buy_ptf] *= 0.5
-        self.weights = self.weights.T
-
-    @staticmethod
-    def _get_inverse_variance_weights(covariance):
-        """
-        Calculate the inverse variance weight allocations.
-
-        :param covariance: (pd.Dataframe) Covariance matrix of assets
-        :return: (list) Inverse variance weight values
-        """
-
-        inv_diag = 1 / np.diag(covariance.values)
-        parity_w = inv_diag * (1 / np.sum(inv_diag))
-        return parity_w
-
-    def _get_cluster_variance(self, covariance, cluster_indices):
-        """
-        Calculate cluster variance.
-
-        :param covariance: (pd.Dataframe) Covariance matrix of assets
-        :param cluster_indices: (list) Asset indices for the cluster
-        :return: (float) Variance of the cluster
-        """
-
-        cluster_covariance = covariance.iloc[cluster_indices, cluster_indices]
-        parity_w = self._get_inverse_variance_weights(cluster_covariance)
-        cluster_variance = self.risk_metrics.calculate_variance(covariance=cluster_covariance, weights=parity_w)
-        return cluster_variance
+        # Align the sides with the weights, which are in quasi-diagonal order
+        sides = np.ascontiguousarray(side_weights[self.weights.index], dtype=np.float64)
+        weights = np.array(self.weights.values[:, 0], dtype=np.float64)
+        _long_short_weights(weights, sides)
+        self.weights = pd.DataFrame([weights], columns=self.weights.index)
 
     def _recursive_bisection(self, covariance, assets):
         """
         Recursively assign weights to the clusters - ultimately assigning weights to the individual assets.
 
-        :param covariance: (pd.Dataframe) The covariance matrix
+        The covariance matrix is permuted once into the quasi-diagonal ordering, which makes every cluster a
+        contiguous block of it, and the whole bisection runs in a single numba kernel over a queue of (start, end)
+        segments.
+
+        :param covariance: (np.array) The covariance matrix
         :param assets: (list) Asset names in the portfolio
         """
-        self.weights = pd.Series(1, index=self.ordered_indices)
-        clustered_alphas = [self.ordered_indices]
-
-        while clustered_alphas:
-            clustered_alphas = [cluster[start:end]
-                                for cluster in clustered_alphas
-                                for start, end in ((0, len(cluster) // 2), (len(cluster) // 2, len(cluster)))
-                                if len(cluster) > 1]
-
-            for subcluster in range(0, len(clustered_alphas), 2):
-                left_cluster = clustered_alphas[subcluster]
-                right_cluster = clustered_alphas[subcluster + 1]
-
-                # Get left and right cluster variances and calculate allocation factor
-                left_cluster_variance = self._get_cluster_variance(covariance, left_cluster)
-                right_cluster_variance = self._get_cluster_variance(covariance, right_cluster)
-                alloc_factor = 1 - left_cluster_variance / (left_cluster_variance + right_cluster_variance)
 
-                # Assign weights to each sub-cluster
-                self.weights[left_cluster] *= alloc_factor
-                self.weights[right_cluster] *= 1 - alloc_factor
+        seriated_covariance = np.ascontiguousarray(covariance[np.ix_(self.ordered_indices, self.ordered_indices)])
+        inv_diag = 1 / np.diag(seriated_covariance)
+        weights = np.ones(len(self.ordered_indices))
+        _bisect_clusters(seriated_covariance, inv_diag, weights)
 
         # Assign actual asset values to weight index
-        self.weights.index = assets[self.ordered_indices]
-        self.weights = pd.DataFrame(self.weights)
+        self.weights = pd.DataFrame(pd.Series(weights, index=assets[self.ordered_indices]))
 
     @staticmethod
-    def _error_checks(asset_prices, asset_returns, covariance_matrix):
+    def _error_checks(asset_prices, asset_returns, covariance_matrix, dtype):
         """
         Perform initial warning checks.
 
@@ -248,9 +256,13 @@ class HierarchicalRiskParity:
                                             indexed by date.
         :param asset_returns: (pd.DataFrame/numpy matrix) User supplied matrix of asset returns.
         :param covariance_matrix: (pd.Dataframe/numpy matrix) User supplied covariance matrix of asset returns
+        :param dtype: (string) Floating point precision of the distances used for Hierarchical Clustering
         """
 
 
+        if dtype not in ('float64', 'float32'):
+            raise ValueError("Supported dtypes for the distances are float64 and float32")
+
         if asset_prices is None and asset_returns is None and covariance_matrix is None:
             raise ValueError(
                 "You need to supply either raw prices or returns or a covariance matrix of asset returns")
@@ -260,3 +272,126 @@ class HierarchicalRiskParity:
                 raise ValueError("Asset prices matrix must be a dataframe")
             if not isinstance(asset_prices.index, pd.DatetimeIndex):
                 raise ValueError("Asset prices dataframe must be indexed by date.")
+
+
+@njit(float64[:, ::1](float64[:, ::1]), nogil=True, cache=True, error_model='numpy')
+def _simple_returns(prices):  # pragma: no cover
+    """
+    "Numbarized" simple returns, prices[t + 1] / prices[t] - 1, written to a single output array.
+
+    :param prices: (np.array) Asset prices with dates in rows and assets in columns
+    :return: (np.array) Simple returns, one row shorter than prices
+    """
+
+    num_dates, num_assets = prices.shape
+    returns = np.empty((num_dates - 1, num_assets))
+    for i in range(num_dates - 1):
+        for j in range(num_assets):
+            returns[i, j] = prices[i + 1, j] / prices[i, j] - 1
+    return returns
+
+
+@njit(float64(float64[:, ::1], float64[::1], intp, intp), nogil=True, cache=True, fastmath=True)
+def _cluster_variance(covariance, inv_diag, start, end):  # pragma: no cover
+    """
+    "Numbarized" variance of a cluster under inverse-variance weights, w' * Cov * w. The cluster is the contiguous
+    block [start, end) of the seriated covariance matrix, which is read in place instead of being copied out.
+
+    :param covariance: (np.array) Covariance matrix of assets in quasi-diagonal order
+    :param inv_diag: (np.array) Inverse of the covariance matrix diagonal
+    :param start: (int) Position of the first asset of the cluster
+    :param end: (int) Position after the last asset of the cluster
+    :return: (float) Variance of the cluster
+    """
+
+    # Closed forms for the single and two asset clusters at the bottom of the tree
+    if end - start == 1:
+        return covariance[start, start]
+    if end - start == 2:
+        var_left, var_right = covariance[start, start], covariance[start + 1, start + 1]
+        var_sum = var_left + var_right
+        return var_left * var_right * (var_sum + 2 * covariance[start, start + 1]) / (var_sum * var_sum)
+
+    # Inverse-variance weights of the cluster
+    parity_w = inv_diag[start:end] / inv_diag[start:end].sum()
+
+    # The covariance is symmetric, so only the upper triangle is read and the off-diagonal terms counted twice
+    cluster_variance = 0.0
+    for i in range(start, end):
+        weight = parity_w[i - start]
+        weighted_cov = 0.0
+        for j in range(i + 1, end):
+            weighted_cov += parity_w[j - start] * covariance[i, j]
+        cluster_variance += weight * (weight * covariance[i, i] + 2 * weighted_cov)
+    return cluster_variance
+
+
+@njit(void(float64[:, ::1], float64[::1], float64[::1]), nogil=True, cache=True)
+def _bisect_clusters(covariance, inv_diag, weights):  # pragma: no cover
+    """
+    "Numbarized" recursive bisection. Clusters are kept as (start, end) segments in a preallocated first-in
+    first-out queue, so they are visited level by level. Every segment is split in half, the weights of both halves
+    are scaled by the allocation factor derived from their cluster variances, and the halves that still hold more
+    than one asset are pushed back onto the queue.
+
+    :param covariance: (np.array) Covariance matrix of assets in quasi-diagonal order
+    :param inv_diag: (np.array) Inverse of the covariance matrix diagonal
+    :param weights: (np.array) Asset weights in quasi-diagonal order, updated in place
+    """
+
+    # A binary split of N assets has at most N - 1 clusters that are split further
+    num_assets = weights.shape[0]
+    starts = np.empty(num_assets, dtype=np.intp)
+    ends = np.empty(num_assets, dtype=np.intp)
+    starts[0], ends[0] = 0, num_assets
+    head, tail = 0, 1 if num_assets > 1 else 0
+
+    while head < tail:
+        start, end = starts[head], ends[head]
+        head += 1
+        mid = (start + end) // 2
+
+        # Get left and right cluster variances and calculate allocation factor
+        left_cluster_variance = _cluster_variance(covariance, inv_diag, start, mid)
+        right_cluster_variance = _cluster_variance(covariance, inv_diag, mid, end)
+        alloc_factor = 1 - left_cluster_variance / (left_cluster_variance + right_cluster_variance)
+
+        # Assign weights to each sub-cluster - both are contiguous slices of the seriated weights
+        weights[start:mid] *= alloc_factor
+        weights[mid:end] *= 1 - alloc_factor
+
+        # Queue the sub-clusters that can be split further
+        for sub_start, sub_end in ((start, mid), (mid, end)):
+            if sub_end - sub_start > 1:
+                starts[tail], ends[tail] = sub_start, sub_end
+                tail += 1
+
+
+@njit(void(float64[::1], float64[::1]), nogil=True, cache=True)
+def _long_short_weights(weights, side_weights):  # pragma: no cover
+    """
+    "Numbarized" long/short adjustment. If there are any short positions, the short weights are rescaled to sum up
+    to -0.5 and the long weights to 0.5, otherwise the weights are left unchanged.
+
+    :param weights: (np.array) Asset weights, updated in place
+    :param side_weights: (np.array) Side of each asset, 1 for Buy and -1 for Sell
+    """
+
+    short_sum, buy_sum, num_short = 0.0, 0.0, 0
+    for i in range(weights.shape[0]):
+        if side_weights[i] == -1:
+            short_sum += weights[i]
+            num_short += 1
+        elif side_weights[i] == 1:
+            buy_sum += weights[i]
+
+    if num_short == 0:
+        return
+
+    for i in range(weights.shape[0]):
+        if side_weights[i] == -1:
+            # Short half size
+            weights[i] = weights[i] / short_sum * -0.5
+        elif side_weights[i] == 1:
+            # Buy other half
+            weights[i] = weights[i] / buy_sum * 0.5
@@ -6,7 +6,7 @@ import unittest
 import os
 import numpy as np
 import pandas as pd
-from mlfinlab.portfolio_optimization.hrp import HierarchicalRiskParity
+from mlfinlab.portfolio_optimization.hrp import HierarchicalRiskParity, _cluster_variance
 from mlfinlab.portfolio_optimization.returns_estimators import ReturnsEstimators
 
 
@@ -71,8 +71,8 @@ class TestHRP(unittest.TestCase):
 
         hrp = HierarchicalRiskParity()
         hrp.allocate(asset_prices=self.data, asset_names=self.data.columns)
-        assert hrp.ordered_indices == [13, 9, 10, 8, 14, 7, 1, 6, 4, 16, 3, 17,
-                                       12, 18, 22, 0, 15, 21, 11, 2, 20, 5, 19]
+        np.testing.assert_array_equal(hrp.ordered_indices, [13, 9, 10, 8, 14, 7, 1, 6, 4, 16, 3, 17,
+                                                            12, 18, 22, 0, 15, 21, 11, 2, 20, 5, 19])
 
     def test_value_error_for_non_dataframe_input(self):
         """
@@ -157,8 +157,8 @@ class TestHRP(unittest.TestCase):
         hrp = HierarchicalRiskParity()
         hrp.allocate(asset_names=self.data.columns, asset_prices=self.data, linkage='ward')
         weights = hrp.weights.values[0]
-        assert hrp.ordered_indices == [13, 7, 1, 6, 4, 16, 3, 17, 14, 0, 15, 8,
-                                       9, 10, 12, 18, 22, 5, 19, 2, 20, 11, 21]
+        np.testing.assert_array_equal(hrp.ordered_indices, [13, 7, 1, 6, 4, 16, 3, 17, 14, 0, 15, 8,
+                                                            9, 10, 12, 18, 22, 5, 19, 2, 20, 11, 21])
         self.assertTrue((weights >= 0).all())
         self.assertTrue(len(weights) == self.data.shape[1])
         self.assertAlmostEqual(np.sum(weights), 1)
@@ -197,3 +197,109 @@ class TestHRP(unittest.TestCase):
             hrp = HierarchicalRiskParity()
             returns = ReturnsEstimators().calculate_returns(asset_prices=self.data)
             hrp.allocate(asset_returns=returns.values)
+
+    def test_correlation_derived_from_covariance(self):
+        """
+        Test that the seriated correlation matrix matches the correlation of the asset returns.
+        """
+
+        hrp = HierarchicalRiskParity()
+        returns = ReturnsEstimators().calculate_returns(asset_prices=self.data)
+        hrp.allocate(asset_names=self.data.columns, covariance_matrix=returns.cov())
+        ordering = hrp.seriated_correlations.index
+        np.testing.assert_almost_equal(hrp.seriated_correlations.values, returns.corr().loc[ordering, ordering].values)
+        self.assertTrue((hrp.seriated_correlations.values <= 1).all())
+        self.assertTrue((hrp.seriated_correlations.values >= -1).all())
+
+    def test_value_error_for_unsupported_dtype(self):
+        """
+        Test ValueError on passing a distance dtype other than float64 or float32.
+        """
+
+        for dtype in ('float16', 'int64'):
+            with self.assertRaises(ValueError):
+                hrp = HierarchicalRiskParity()
+                hrp.allocate(asset_prices=self.data, dtype=dtype)
+
+    def test_returns_match_returns_estimator(self):
+        # pylint: disable=protected-access
+        """
+        Test that the returns used by HRP match ReturnsEstimators, including forward padding of missing prices.
+        """
+
+        data = self.data.copy()
+        data.iloc[:5, 0] = np.nan
+        data.iloc[100:103, 3] = np.nan
+        expected_returns = ReturnsEstimators().calculate_returns(asset_prices=data)
+        pd.testing.assert_frame_equal(HierarchicalRiskParity._calculate_returns(data), expected_returns)
+
+    def test_covariance_matches_pandas(self):
+        # pylint: disable=protected-access
+        """
+        Test that the covariance used by HRP matches pandas, both with and without missing returns.
+        """
+
+        returns = ReturnsEstimators().calculate_returns(asset_prices=self.data)
+        np.testing.assert_almost_equal(HierarchicalRiskParity._calculate_covariance(returns), returns.cov().values)
+        returns.iloc[10:20, 2] = np.nan
+        np.testing.assert_almost_equal(HierarchicalRiskParity._calculate_covariance(returns), returns.cov().values)
+
+    def test_long_short_half_sizes(self):
+        """
+        Test that the short and long legs of a Long Short Portfolio are each half the size of the portfolio.
+        """
+
+        hrp = HierarchicalRiskParity()
+        side_weights = pd.Series([1] * self.data.shape[1], index=self.data.columns)
+        side_weights.loc[self.data.columns[:4]] = -1
+        hrp.allocate(asset_prices=self.data, side_weights=side_weights)
+        weights = hrp.weights.iloc[0]
+        np.testing.assert_almost_equal(weights[self.data.columns[:4]].sum(), -0.5)
+        np.testing.assert_almost_equal(weights[self.data.columns[4:]].sum(), 0.5)
+        self.assertTrue((weights[self.data.columns[:4]] < 0).all())
+
+    def test_hrp_with_float32_distances(self):
+        """
+        Test HRP when the distances used for clustering are computed in float32.
+        """
+
+        hrp = HierarchicalRiskParity()
+        hrp.allocate(asset_prices=self.data, dtype='float32')
+        weights = hrp.weights.values[0]
+        self.assertEqual(hrp.seriated_distances.values.dtype, np.float32)
+        np.testing.assert_array_equal(hrp.ordered_indices, [13, 9, 10, 8, 14, 7, 1, 6, 4, 16, 3, 17,
+                                                            12, 18, 22, 0, 15, 21, 11, 2, 20, 5, 19])
+        self.assertTrue((weights >= 0).all())
+        np.testing.assert_almost_equal(np.sum(weights), 1)
+
+    def test_hrp_weights_values(self):
+        """
+        Test the weights calculated by the HRP algorithm against values from the original pandas implementation.
+        """
+
+        hrp = HierarchicalRiskParity()
+        hrp.allocate(asset_prices=self.data)
+        expected_weights = pd.Series([0.008511303767, 0.003152641245, 0.002142954559, 0.002329278389, 0.001919873083,
+                                      0.00317880988, 0.001338550795, 0.001322051841, 0.003565726258, 0.001709079931,
+                                      0.002432847281, 0.01003293281, 0.005999168477, 0.006235664332, 0.01229836509,
+                                      0.002298149053, 0.001825054173, 0.3790673809, 0.0723651237, 0.1282345856,
+                                      0.2653554565, 0.06933871313, 0.01534628927],
+                                     index=['XLU', 'XLE', 'XLF', 'XLB', 'EPP', 'EWU', 'EWG', 'EWQ', 'EFA', 'VGK',
+                                            'EWJ', 'VPL', 'XLK', 'SPY', 'DIA', 'EEM', 'FXI', 'CSJ', 'LQD', 'TIP',
+                                            'BND', 'IEF', 'TLT'])
+        self.assertListEqual(list(hrp.weights.columns), list(expected_weights.index))
+        np.testing.assert_almost_equal(hrp.weights.values[0], expected_weights.values, decimal=10)
+
+    def test_cluster_variance(self):
+        """
+        Test the cluster variance kernel against w' * Cov * w with inverse-variance weights, including the single
+        and two asset clusters that use closed forms.
+        """
+
+        returns = ReturnsEstimators().calculate_returns(asset_prices=self.data)
+        covariance = np.ascontiguousarray(returns.cov().values)
+        inv_diag = 1 / np.diag(covariance)
+        for start, end in ((3, 4), (22, 23), (5, 7), (0, 2), (4, 7), (0, 23), (10, 16)):
+            parity_w = inv_diag[start:end] / inv_diag[start:end].sum()
+            expected_variance = parity_w @ covariance[start:end, start:end] @ parity_w
+            self.assertAlmostEqual(_cluster_variance(covariance, inv_diag, start, end) / expected_variance, 1)